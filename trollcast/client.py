@@ -294,7 +294,7 @@ class SimpleRequester(object):
                     rep = Message(rawstr=reply)
                     if rep.binary:
                         logger.debug("Got reply: "
-                                     + " ".join(str(rep).split()[:6]))
+                                     + " ".join(reply.split(None, 6)[:6]))
                     else:
                         logger.debug("Got reply: " + str(rep))
                     self.failures = 0
@@ -38,6 +38,7 @@ import time
 from datetime import datetime, timedelta
 from posttroll import strp_isoformat
 from fnmatch import fnmatch
+from bisect import bisect_left, insort
 from pyinotify import (WatchManager, ProcessEvent, ThreadedNotifier,
                        IN_MODIFY, IN_OPEN, IN_CLOSE_WRITE)
 from urlparse import urlparse
@@ -67,7 +68,8 @@ def get_f_elev(satellite):
     orb = Orbital(satellite.upper(), tle_file)
 
     def f_elev(utctime):
-        """Get the elevation for the given *utctime*.
+        """Get the elevation for the given *utctime*, which can also be an
+        array of times.
         """
         return orb.get_observer_look(utctime, *coords)[1]
     f_elev.satellite = satellite
@@ -83,44 +85,56 @@ class CADU(object):
         return False
 
 
+HRPT_DTYPE = np.dtype([('frame_sync', '>u2', (6, )),
+                       ('id', [('id', '>u2'),
+                               ('spare', '>u2')]),
+                       ('timecode', '>u2', (4, )),
+                       ('telemetry', [("ramp_calibration", '>u2', (5, )),
+                                      ("PRT", '>u2', (3, )),
+                                      ("ch3_patch_temp", '>u2'),
+                                      ("spare", '>u2'), ]),
+                       ('back_scan', '>u2', (10, 3)),
+                       ('space_data', '>u2', (10, 5)),
+                       ('sync', '>u2'),
+                       ('TIP_data', '>u2', (520, )),
+                       ('spare', '>u2', (127, )),
+                       ('image_data', '>u2', (2048, 5)),
+                       ('aux_sync', '>u2', (100, ))])
+
+HRPT_SYNC = np.array([994, 1011, 437, 701, 644, 277, 452, 467, 833, 224,
+                      694, 990, 220, 409, 1010, 403, 654, 105, 62, 867,
+                      75, 149, 320, 725, 668, 581, 866, 109, 166, 941,
+                      1022, 59, 989, 182, 461, 197, 751, 359, 704, 66,
+                      387, 238, 850, 746, 473, 573, 282, 6, 212, 169, 623,
+                      761, 979, 338, 249, 448, 331, 911, 853, 536, 323,
+                      703, 712, 370, 30, 900, 527, 977, 286, 158, 26, 796,
+                      705, 100, 432, 515, 633, 77, 65, 489, 186, 101, 406,
+                      560, 148, 358, 742, 113, 878, 453, 501, 882, 525,
+                      925, 377, 324, 589, 594, 496, 972], dtype=np.uint16)
+HRPT_SYNC.setflags(write=False)
+
+HRPT_SYNC_START = np.array([644, 367, 860, 413, 527, 149], dtype=np.uint16)
+HRPT_SYNC_START.setflags(write=False)
+
+
 class HRPT(object):
 
     """The hrpt reader class
     """
-    dtype = np.dtype([('frame_sync', '>u2', (6, )),
-                      ('id', [('id', '>u2'),
-                              ('spare', '>u2')]),
-                      ('timecode', '>u2', (4, )),
-                      ('telemetry', [("ramp_calibration", '>u2', (5, )),
-                                     ("PRT", '>u2', (3, )),
-                                     ("ch3_patch_temp", '>u2'),
-                                     ("spare", '>u2'), ]),
-                      ('back_scan', '>u2', (10, 3)),
-                      ('space_data', '>u2', (10, 5)),
-                      ('sync', '>u2'),
-                      ('TIP_data', '>u2', (520, )),
-                      ('spare', '>u2', (127, )),
-                      ('image_data', '>u2', (2048, 5)),
-                      ('aux_sync', '>u2', (100, ))])
-
-    hrpt_sync = np.array([994, 1011, 437, 701, 644, 277, 452, 467, 833, 224,
-                          694, 990, 220, 409, 1010, 403, 654, 105, 62, 867,
-                          75, 149, 320, 725, 668, 581, 866, 109, 166, 941,
-                          1022, 59, 989, 182, 461, 197, 751, 359, 704, 66,
-                          387, 238, 850, 746, 473, 573, 282, 6, 212, 169, 623,
-                          761, 979, 338, 249, 448, 331, 911, 853, 536, 323,
-                          703, 712, 370, 30, 900, 527, 977, 286, 158, 26, 796,
-                          705, 100, 432, 515, 633, 77, 65, 489, 186, 101, 406,
-                          560, 148, 358, 742, 113, 878, 453, 501, 882, 525,
-                          925, 377, 324, 589, 594, 496, 972], dtype=np.uint16)
-
-    hrpt_sync_start = np.array([644, 367, 860, 413, 527, 149], dtype=np.uint16)
+    dtype = HRPT_DTYPE
+
+    hrpt_sync = HRPT_SYNC
+
+    hrpt_sync_start = HRPT_SYNC_START
 
     satellites = {7: "NOAA 15",
                   3: "NOAA 16",
                   13: "NOAA 18",
                   15: "NOAA 19"}
 
+    satellite_names = np.array(["unknown"] * 16, dtype=object)
+    satellite_names[satellites.keys()] = satellites.values()
+
     line_size = 11090 * 2
 
     @staticmethod
@@ -129,18 +143,17 @@ class HRPT(object):
 
     @staticmethod
     def timecode(tc_array):
-        """HRPT timecode reading
+        """HRPT timecode reading, for one or several lines at once.
+
+        Returns the time since the start of the year as a timedelta64.
         """
-        word = tc_array[0]
-        day = word
-        word = tc_array[1]
-        msecs = ((127) & word) * 1024
-        word = tc_array[2]
-        msecs += word & 1023
-        msecs *= 1024
-        word = tc_array[3]
-        msecs += word & 1023
-        return timedelta(days=int(day / 2 - 1), milliseconds=int(msecs))
+        tc_array = tc_array.astype(np.int64)
+        days = tc_array[..., 0] // 2 - 1
+        msecs = (((tc_array[..., 1] & 127) * 1024 +
+                  (tc_array[..., 2] & 1023)) * 1024 +
+                 (tc_array[..., 3] & 1023))
+        return (days.astype('timedelta64[D]') +
+                msecs.astype('timedelta64[ms]'))
 
     def __init__(self, sat, reftime):
         self.sat = sat
@@ -149,7 +162,7 @@ class HRPT(object):
         self.time_threshold = timedelta(seconds=600)
         self.reftimes = []
         self.last_time = None
-        self.lags = [0]
+        self.max_lag = 0
 
     def read(self, data, f_elev=None):
         """Read hrpt data.
@@ -157,27 +170,40 @@ class HRPT(object):
 
         now = datetime.utcnow()
         year = now.year
-
-        for i, line in enumerate(np.fromstring(data, dtype=self.dtype,
-                                               count=len(data) / self.line_size)):
-            days = self.timecode(line["timecode"])
-            utctime = datetime(year, 1, 1) + days
-
-            if utctime > now:
-                # Can't have data from the future... yet :)
-                utctime = datetime(year - 1, 1, 1) + days
-
-            qual = (np.sum(line['aux_sync'] == self.hrpt_sync) +
-                    np.sum(line['frame_sync'] == self.hrpt_sync_start))
-            qual = 100 * (qual / 106.0)
-
-            qual -= np.sum(abs(np.diff(line['image_data']
-                                       [:, 4].astype(np.int16))) > 200)
-
-            if np.sum(line['frame_sync'] == self.hrpt_sync_start) < 5:
-                logger.info("Frame sync not in place, setting quality to 0")
-                qual = 0
-
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        lines = np.frombuffer(data, dtype=self.dtype,
+                              count=len(data) // self.line_size)
+
+        # Compute the sync based quality of all the lines at once.
+        frame_sync = np.sum(lines['frame_sync'] == self.hrpt_sync_start,
+                            axis=1)
+        quals = 100 * ((np.sum(lines['aux_sync'] == self.hrpt_sync, axis=1) +
+                        frame_sync) / 106.0)
+        quals -= np.sum(abs(np.diff(lines['image_data'][:, :, 4]
+                                    .astype(np.int16), axis=1)) > 200,
+                        axis=1)
+
+        no_sync = frame_sync < 5
+        if np.any(no_sync):
+            logger.info("Frame sync not in place for %d line(s), "
+                        "setting quality to 0", np.sum(no_sync))
+            quals[no_sync] = 0
+
+        days = self.timecode(lines['timecode'])
+        utctimes = np.datetime64('%04d-01-01' % year) + days
+        # Can't have data from the future... yet :)
+        future = utctimes > np.datetime64(now)
+        utctimes[future] = (np.datetime64('%04d-01-01' % (year - 1)) +
+                            days[future])
+
+        sat_names = self.satellite_names[(lines['id']['id'] >> 3) & 15]
+
+        # Computed for all the lines at once when first needed.
+        elevations = None
+
+        for i, (qual, utctime, sat_name) in enumerate(
+                zip(quals, utctimes.astype(datetime), sat_names)):
             # Take care of noisy time codes.
 
             new_time = datetime.now()
@@ -188,19 +214,19 @@ class HRPT(object):
                 seconds = (time_diff.days * 24 * 60 * 60
                            + time_diff.seconds
                            + time_diff.microseconds / 1000000.0)
-                self.lags.append(seconds)
+                self.max_lag = max(self.max_lag, seconds)
                 if(abs(utctime - (self.reftime +
                                   timedelta(seconds=self.count / 6.0 +
-                                            max(self.lags))))
+                                            self.max_lag)))
                    < timedelta(seconds=15)):
                     logger.debug(
                         "Looks like we lost some scanlines, adjusting %s counts.", seconds * 6.0)
 
-                    self.count += int(max(self.lags) * 6.0)
+                    self.count += int(self.max_lag * 6.0)
                     self.time_threshold = max(timedelta(seconds=15),
                                               self.time_threshold)
                     self.reftimes = []
-                    self.lags = [0]
+                    self.max_lag = 0
 
             # Adjust reference time upon good quality scanlines
             if qual >= 99.9:
@@ -226,8 +252,8 @@ class HRPT(object):
                     > self.time_threshold):
                 # Check if scanline is within expected range
                 logger.debug("Spurious time for scanline %s (should be %s)",
-                             str(utctime),
-                             str((self.reftime + timedelta(seconds=self.count / 6.0))))
+                             utctime,
+                             self.reftime + timedelta(seconds=self.count / 6.0))
                 qual = 0
 
             self.count += 1
@@ -235,10 +261,10 @@ class HRPT(object):
 
             qual = max(0, qual)
 
-            logger.info("Quality " + str(qual))
+            logger.info("Quality %s", qual)
 
             if qual != 100:
-                logger.info("Degraded line: " + str(utctime))
+                logger.info("Degraded line: %s", utctime)
                 if f_elev is None:
                     satellite = "unknown"
                     yield ((satellite, utctime, None, qual,
@@ -248,23 +274,21 @@ class HRPT(object):
                 else:
                     satellite = f_elev.satellite
             else:
-                try:
-                    satellite = self.satellites[((line["id"]["id"] >> 3) & 15)]
-                except KeyError:
-                    satellite = "unknown"
+                satellite = sat_name
+
+            if f_elev is None and satellite != "unknown":
+                f_elev = get_f_elev(satellite)
 
             if f_elev is None:
-                if satellite != "unknown":
-                    f_elev = get_f_elev(satellite)
-                    elevation = f_elev(utctime)
-                else:
-                    elevation = -180
+                elevation = -180
             else:
-                elevation = f_elev(utctime)
+                if elevations is None:
+                    elevations = f_elev(utctimes)
+                elevation = elevations[i]
 
-            logger.debug("Got line " + utctime.isoformat() + " "
-                         + satellite + " "
-                         + str(elevation))
+            if debug:
+                logger.debug("Got line %s %s %s",
+                             utctime.isoformat(), satellite, elevation)
 
             # TODO:
             # - serve also already present files
@@ -288,13 +312,25 @@ class FileWatcher(Thread):
         self._holder = holder
         self._uri = uri
         self._schedule_reader = schedule_reader
-        self._notifier = ThreadedNotifier(self._wm,
-                                          _EventHandler(self._holder,
-                                                        self._uri,
-                                                        self._schedule_reader,
-                                                        self._error_event))
+        self._notifier = self._create_notifier()
         self._path, self._pattern = os.path.split(urlparse(uri).path)
 
+    def _create_notifier(self):
+        """Create the inotify notifier.
+
+        Events are read at most every 0.1 seconds and duplicate events
+        within a batch are discarded, so that a burst of writes to the file
+        triggers only one read.
+        """
+        notifier = ThreadedNotifier(self._wm,
+                                    _EventHandler(self._holder,
+                                                  self._uri,
+                                                  self._schedule_reader,
+                                                  self._error_event),
+                                    read_freq=0.1)
+        notifier.coalesce_events()
+        return notifier
+
     def start(self):
         """Start the file watcher
         """
@@ -308,12 +344,7 @@ class FileWatcher(Thread):
                 self._error_event.clear()
                 self._notifier.stop()
                 del self._notifier
-                self._notifier = ThreadedNotifier(
-                    self._wm,
-                    _EventHandler(self._holder,
-                                  self._uri,
-                                  self._schedule_reader,
-                                  self._error_event))
+                self._notifier = self._create_notifier()
                 self._notifier.start()
                 self._wm.add_watch(
                     self._path, IN_OPEN | IN_CLOSE_WRITE | IN_MODIFY)
@@ -340,6 +371,7 @@ class _EventHandler(ProcessEvent):
         self._error_event = error_event
 
         self._path, self._pattern = os.path.split(urlparse(self._uri).path)
+        self._glob = globify(self._pattern)
 
         self._readers = {}
         self._fp = None
@@ -389,9 +421,14 @@ class _EventHandler(ProcessEvent):
                 position = 0
                 f_elev = None
 
+            # Only read what has been added since last time.
+            size = os.fstat(self._fp.fileno()).st_size
+            if size <= position:
+                return
+
             self._fp.seek(position)
 
-            data = self._fp.read()
+            data = self._fp.read(size - position)
 
             if position == 0:
                 for filetype in FORMATS:
@@ -429,7 +466,7 @@ class _EventHandler(ProcessEvent):
 
         fname = os.path.basename(event.pathname)
 
-        if not fnmatch(fname, globify(self._pattern)):
+        if not fnmatch(fname, self._glob):
             logger.debug("Ignoring %s", event.pathname)
             return False
 
@@ -440,7 +477,7 @@ class _EventHandler(ProcessEvent):
             self.current_event = event
 
         if self._fp is None:
-            self._fp = open(event.pathname)
+            self._fp = open(event.pathname, "rb")
             self._current_pass = self._schedule_reader.next_pass
             info = parse(self._pattern, fname)
             try:
@@ -461,17 +498,10 @@ class _EventHandler(ProcessEvent):
 
         logger.debug("File modified! %s", event.pathname)
 
-        fname = os.path.basename(event.pathname)
-
-        if not fnmatch(fname, globify(self._pattern)):
-            return
-
-        self.set_reception_active(event)
-
-        for sat, key, elevation, qual, data in self._reader(event.pathname,
-                                                            self._current_pass):
-            if qual > 0:
-                self._holder.add(sat, key, elevation, qual, data)
+        self._holder.add_many([elt for elt in
+                               self._reader(event.pathname,
+                                            self._current_pass)
+                               if elt[3] > 0])
 
     # def process_IN_CLOSE_WRITE(self, event):
     def clean_up(self, event):
@@ -479,7 +509,7 @@ class _EventHandler(ProcessEvent):
         """
         fname = os.path.basename(event.pathname)
 
-        if not fnmatch(fname, globify(self._pattern)):
+        if not fnmatch(fname, self._glob):
             return
 
         if self._fp is not None:
@@ -642,11 +672,11 @@ class Cleaner(Thread):
         """Clean the db
         """
         logger.debug("Cleaning")
+        cutoff = datetime.utcnow() - timedelta(hours=self._delay)
         for sat in self._holder.sats():
-            satlines = self._holder.get_sat(sat)
-            for key in sorted(satlines):
-                if key < datetime.utcnow() - timedelta(hours=self._delay):
-                    self._holder.delete(sat, key)
+            keys = self._holder.keys_before(sat, cutoff)
+            if keys:
+                self._holder.delete_many(sat, keys)
 
     def run(self):
         while self._loop:
@@ -667,9 +697,15 @@ class Holder(object):
 
     def __init__(self, pub, origin):
         self._data = {}
+        # sorted keys of each satellite
+        self._keys = {}
         self._pub = pub
         self._origin = origin
         self._lock = Lock()
+        # Reused for every "have" message, so that the sender doesn't have to
+        # be looked up for each scanline.
+        self._have_msg = Message(subject, "have", {"origin": origin})
+        self._have_lock = Lock()
 
     def delete(self, sat, key):
         """Delete item
@@ -677,12 +713,33 @@ class Holder(object):
         logger.debug("Removing from memory: " + str((sat, key)))
         with self._lock:
             del self._data[sat][key]
+            keys = self._keys[sat]
+            del keys[bisect_left(keys, key)]
+
+    def delete_many(self, sat, keys):
+        """Delete the items of *sat* for all the given *keys*.
+        """
+        logger.debug("Removing %d lines of %s from memory", len(keys), sat)
+        keys = set(keys)
+        with self._lock:
+            satlines = self._data[sat]
+            for key in keys:
+                satlines.pop(key, None)
+            self._keys[sat] = [key for key in self._keys[sat]
+                               if key not in keys]
 
     def get_sat(self, sat):
         """Get the data for a given satellite *sat*.
         """
         return self._data[sat]
 
+    def keys_before(self, sat, cutoff):
+        """Get the keys of *sat* older than *cutoff*, oldest first.
+        """
+        with self._lock:
+            keys = self._keys[sat]
+            return keys[:bisect_left(keys, cutoff)]
+
     def sats(self):
         """return the satellites in store.
         """
@@ -691,8 +748,9 @@ class Holder(object):
     def get(self, sat, key):
         """get the value of *sat* and *key*
         """
-        with self._lock:
-            return self._data[sat][key]
+        # No lock needed, dict lookups are atomic and only writers have to
+        # keep _data and _keys consistent.
+        return self._data[sat][key]
 
     def get_data(self, sat, key):
         """get the data of *sat* and *key*
@@ -702,10 +760,21 @@ class Holder(object):
     def add(self, sat, key, elevation, qual, data):
         """Add some data.
         """
+        self.add_many([(sat, key, elevation, qual, data)])
+
+    def add_many(self, lines):
+        """Add several lines of data at once, given as (sat, key, elevation,
+        qual, data) tuples.
+        """
         with self._lock:
-            self._data.setdefault(sat, {})[key] = elevation, qual, data
-        logger.debug("Got stuff for " + str((sat, key, elevation, qual)))
-        self.have(sat, key, elevation, qual)
+            for sat, key, elevation, qual, data in lines:
+                satlines = self._data.setdefault(sat, {})
+                if key not in satlines:
+                    insort(self._keys.setdefault(sat, []), key)
+                satlines[key] = elevation, qual, data
+        for sat, key, elevation, qual, data in lines:
+            logger.debug("Got stuff for " + str((sat, key, elevation, qual)))
+            self.have(sat, key, elevation, qual)
 
     def have(self, sat, key, elevation, qual):
         """Tell the world about our new data.
@@ -716,9 +785,12 @@ class Holder(object):
         to_send["elevation"] = elevation
         to_send["quality"] = qual
         to_send["origin"] = self._origin
-        logger.info(str(to_send))
+        logger.info("%s", to_send)
 
-        msg = Message(subject, "have", to_send).encode()
+        with self._have_lock:
+            self._have_msg.time = datetime.utcnow()
+            self._have_msg.data = to_send
+            msg = self._have_msg.encode()
         self._pub.send(msg)
 
 
@@ -735,8 +807,9 @@ class Publisher(object):
     def send(self, message):
         """Publish something
         """
+        rawstr = str(message)
         with self._lock:
-            self._socket.send(str(message))
+            self._socket.send(rawstr)
 
     def stop(self):
         """Stop publishing.
@@ -830,7 +903,6 @@ class RequestManager(Thread):
         self._loop = True
         self._port = port
         self._station = station
-        self._lock = Lock()
         self._socket = context.socket(REP)
         self._socket.bind("tcp://*:" + str(self._port))
         self._poller = Poller()
@@ -839,11 +911,12 @@ class RequestManager(Thread):
     def send(self, message):
         """Send a message
         """
+        rawstr = str(message)
         if message.binary:
-            logger.debug("Response: " + " ".join(str(message).split()[:6]))
+            logger.debug("Response: " + " ".join(rawstr.split(None, 6)[:6]))
         else:
-            logger.debug("Response: " + str(message))
-        self._socket.send(str(message))
+            logger.debug("Response: " + rawstr)
+        self._socket.send(rawstr)
 
     def pong(self):
         """Reply to ping
@@ -883,28 +956,25 @@ class RequestManager(Thread):
                 logger.info("Poller interrupted.")
                 continue
             if self._socket in socks and socks[self._socket] == POLLIN:
-                logger.debug("Received a request, waiting for the lock")
-                with self._lock:
-                    message = Message(rawstr=self._socket.recv(NOBLOCK))
-                    logger.debug("processing request: " + str(message))
-                    reply = Message(subject, "error")
-                    try:
-                        if message.type == "ping":
-                            reply = self.pong()
-                        elif (message.type == "request" and
-                              message.data["type"] == "scanline"):
-                            reply = self.scanline(message)
-                        elif (message.type == "notice" and
-                              message.data["type"] == "scanline"):
-                            reply = self.notice(message)
-                        else:  # unknown request
-                            reply = self.unknown(message)
-                    except:
-                        logger.exception("Something went wrong"
-                                         " when processing the request:")
-                    finally:
-                        self.send(reply)
-                logger.debug("Lock released from manager")
+                message = Message(rawstr=self._socket.recv(NOBLOCK))
+                logger.debug("processing request: " + str(message))
+                reply = Message(subject, "error")
+                try:
+                    if message.type == "ping":
+                        reply = self.pong()
+                    elif (message.type == "request" and
+                          message.data["type"] == "scanline"):
+                        reply = self.scanline(message)
+                    elif (message.type == "notice" and
+                          message.data["type"] == "scanline"):
+                        reply = self.notice(message)
+                    else:  # unknown request
+                        reply = self.unknown(message)
+                except:
+                    logger.exception("Something went wrong"
+                                     " when processing the request:")
+                finally:
+                    self.send(reply)
             else:  # timeout
                 pass
 
@@ -36,6 +36,10 @@ sys.modules["pyorbital.orbital"] = MagicMock()
 from trollcast import server
 import time
 import random
+import os
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
 
 server.set_subject("bla")
 
@@ -100,15 +104,20 @@ class TestHolder(unittest.TestCase):
     def test_have(self):
         """Test Holder.have
         """
-        self.holder.have(1, 2, 3, 4)
         server.Message.assert_called_with(server.subject,
                                           'have',
-                                          {"satellite": 1,
-                                           "timecode": 2,
-                                           "elevation": 3,
-                                           "quality": 4,
-                                           "origin": self.origin})
-        self.pub.send.assert_called_with(server.Message.return_value.encode.return_value)
+                                          {"origin": self.origin})
+        server.Message.reset_mock()
+        self.holder.have(1, 2, 3, 4)
+        self.assertEquals(server.Message.call_count, 0)
+        msg = self.holder._have_msg
+        self.assertEquals(msg.data, {"satellite": 1,
+                                     "timecode": 2,
+                                     "elevation": 3,
+                                     "quality": 4,
+                                     "origin": self.origin})
+        self.assertTrue(isinstance(msg.time, datetime))
+        self.pub.send.assert_called_with(msg.encode.return_value)
 
     # FIXME: test race conditions on add/get_data
     @patch.object(server.Holder, 'have')
@@ -128,14 +137,221 @@ class TestHolder(unittest.TestCase):
 
         self.assertRaises(KeyError, self.holder.get, *args[:2])
 
+    @patch.object(server.Holder, 'have')
+    def test_add_many(self, have):
+        """Test Holder.add_many
+        """
+        lines = [(1, 3, 3, 4, 5), (1, 2, 3, 4, 6), (2, 2, 3, 4, 7)]
+        self.holder.add_many(lines)
+        self.assertEquals(have.call_args_list,
+                          [((1, 3, 3, 4), {}), ((1, 2, 3, 4), {}),
+                           ((2, 2, 3, 4), {})])
+        self.assertEquals(self.holder.get_data(1, 3), 5)
+        self.assertEquals(self.holder.get_data(1, 2), 6)
+        self.assertEquals(self.holder.get_data(2, 2), 7)
+        self.assertEquals(self.holder.keys_before(1, 4), [2, 3])
+
+    @patch.object(server.Holder, 'have')
+    def test_delete_many(self, have):
+        """Test Holder.delete_many
+        """
+        for key in range(5):
+            self.holder.add("sat", key, 0, 100, "data")
+        self.holder.delete_many("sat", [0, 3, 1])
+        self.assertEquals(sorted(self.holder.get_sat("sat")), [2, 4])
+        self.assertEquals(self.holder.keys_before("sat", 5), [2, 4])
+        self.assertRaises(KeyError, self.holder.get, "sat", 3)
+
+    @patch.object(server.Holder, 'have')
+    def test_get_while_adding(self, have):
+        """Test that getting data doesn't wait for writers
+        """
+        self.holder.add(1, 2, 3, 4, 5)
+        with self.holder._lock:
+            self.assertEquals(self.holder.get_data(1, 2), 5)
+
+    @patch.object(server.Holder, 'have')
+    def test_keys_before(self, have):
+        """Test Holder.keys_before
+        """
+        for key in (5, 1, 3, 2, 4, 3):
+            self.holder.add("sat", key, 0, 100, "data")
+        self.assertEquals(self.holder.keys_before("sat", 3), [1, 2])
+        self.assertEquals(self.holder.keys_before("sat", 6), [1, 2, 3, 4, 5])
+        self.holder.delete("sat", 2)
+        self.assertEquals(self.holder.keys_before("sat", 3), [1])
+
+
+class TestCleaner(unittest.TestCase):
+
+    @patch.object(server.Holder, 'have')
+    def test_clean(self, have):
+        """Test cleaning old lines
+        """
+        holder = server.Holder(MagicMock(), MagicMock())
+        now = datetime.utcnow()
+        old_keys = [now - timedelta(hours=2), now - timedelta(minutes=61)]
+        new_keys = [now - timedelta(minutes=59), now]
+        for key in old_keys + new_keys:
+            holder.add("sat", key, 0, 100, "data")
+        cleaner = server.Cleaner(holder, 1)
+        cleaner.clean()
+        self.assertEquals(sorted(holder.get_sat("sat")), new_keys)
+        self.assertEquals(holder.keys_before("sat", now + timedelta(1)),
+                          new_keys)
+
+
 
 
+class TestHRPT(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = np.zeros(3, dtype=server.HRPT.dtype)
+        self.lines['frame_sync'] = server.HRPT.hrpt_sync_start
+        self.lines['aux_sync'] = server.HRPT.hrpt_sync
+        self.lines['id']['id'] = 7 << 3
+        # january 1st, 1000 ms + one line every 1/6th of a second.
+        self.lines['timecode'][:, 0] = 2
+        msecs = np.array([1000, 1167, 1333])
+        self.lines['timecode'][:, 2] = msecs >> 10
+        self.lines['timecode'][:, 3] = msecs & 1023
+
+        self.now = datetime.utcnow()
+        self.reftime = datetime(self.now.year, 1, 1, 0, 0, 1)
+        self.hrpt = server.HRPT("NOAA 15", self.reftime)
+
+        self.f_elev = MagicMock(
+            side_effect=lambda utctimes: np.zeros(len(utctimes)) + 42)
+        self.f_elev.satellite = "NOAA 15"
+
+    def test_timecode(self):
+        """Test HRPT.timecode
+        """
+        tc_array = np.array([[2, 0, 0, 1000],
+                             [730, 82, 406, 1023]], dtype=np.uint16)
+        res = server.HRPT.timecode(tc_array)
+        self.assertEquals(res[0].astype(timedelta),
+                          timedelta(milliseconds=1000))
+        self.assertEquals(res[1].astype(timedelta),
+                          timedelta(days=364, hours=23, minutes=59,
+                                    seconds=59, milliseconds=999))
+        self.assertEquals(server.HRPT.timecode(tc_array[0]).astype(timedelta),
+                          timedelta(milliseconds=1000))
+
+    def test_read(self):
+        """Test HRPT.read
+        """
+        data = self.lines.tostring()
+        res = list(self.hrpt.read(data, self.f_elev))
+        self.assertEquals(len(res), 3)
+        for i, (elt, offset, f_elev) in enumerate(res):
+            sat, utctime, elevation, qual, line = elt
+            self.assertEquals(sat, "NOAA 15")
+            self.assertEquals(utctime,
+                              self.reftime + timedelta(milliseconds=[0, 167, 333][i]))
+            self.assertEquals(elevation, 42)
+            self.assertEquals(qual, 100)
+            self.assertEquals(line, data[i * server.HRPT.line_size:
+                                         (i + 1) * server.HRPT.line_size])
+            self.assertEquals(offset, (i + 1) * server.HRPT.line_size)
+            self.assertTrue(f_elev is self.f_elev)
+        self.assertEquals(self.f_elev.call_count, 1)
+
+    def test_read_bad_sync(self):
+        """Test HRPT.read on lines with broken syncs
+        """
+        self.lines['frame_sync'][1] = 0
+        self.lines['aux_sync'][2, :10] = 0
+        res = list(self.hrpt.read(self.lines.tostring(), self.f_elev))
+        quals = [elt[3] for elt, offset, f_elev in res]
+        self.assertEquals(quals[0], 100)
+        self.assertEquals(quals[1], 0)
+        self.assertAlmostEquals(quals[2], 100 * 96 / 106.0)
+
+    @patch.object(server, 'get_f_elev')
+    def test_read_satellite(self, get_f_elev):
+        """Test the satellite id of the lines
+        """
+        self.lines['id']['id'] = [3 << 3, 15 << 3 | 5, 1 << 3]
+        res = list(self.hrpt.read(self.lines.tostring(), None))
+        sats = [elt[0] for elt, offset, f_elev in res]
+        self.assertEquals(sats, ["NOAA 16", "NOAA 19", "unknown"])
+
+
+class TestFileWatcher(unittest.TestCase):
+
+    @patch.object(server, '_EventHandler')
+    @patch.object(server, 'WatchManager')
+    @patch.object(server, 'ThreadedNotifier')
+    def test_create_notifier(self, ThreadedNotifier, WatchManager,
+                             _EventHandler):
+        """Test that the notifier coalesces events
+        """
+        holder = MagicMock()
+        sched = MagicMock()
+        watcher = server.FileWatcher(holder, "/tmp/*.hmf", sched)
+        ThreadedNotifier.assert_called_once_with(WatchManager.return_value,
+                                                 _EventHandler.return_value,
+                                                 read_freq=0.1)
+        ThreadedNotifier.return_value.coalesce_events.assert_called_once_with()
+        self.assertTrue(watcher._notifier is ThreadedNotifier.return_value)
+
+
+class TestEventHandler(unittest.TestCase):
+
+    def setUp(self):
+        sched = MagicMock()
+        sched.next_pass = None
+        self.handler = server._EventHandler(MagicMock(), "/tmp/*.hmf", sched,
+                                            MagicMock())
+        now = datetime.utcnow()
+        self.handler.time = datetime(now.year, 1, 1, 0, 0, 1)
+        self.lines = np.zeros(3, dtype=server.HRPT.dtype)
+        self.lines['frame_sync'] = server.HRPT.hrpt_sync_start
+        self.lines['aux_sync'] = server.HRPT.hrpt_sync
+        self.lines['id']['id'] = 7 << 3
+        self.lines['timecode'][:, 0] = 2
+        msecs = np.array([1000, 1167, 1333])
+        self.lines['timecode'][:, 2] = msecs >> 10
+        self.lines['timecode'][:, 3] = msecs & 1023
+        self.fd, self.filename = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.filename)
+
+    @patch.object(server, 'get_f_elev')
+    def test_reader(self, get_f_elev):
+        """Test reading only the new lines of the file
+        """
+        os.write(self.fd, self.lines[:2].tostring())
+        self.handler._fp = open(self.filename, "rb")
+        try:
+            res = list(self.handler._reader(self.filename, None))
+            self.assertEquals(len(res), 2)
+            self.assertEquals(list(self.handler._reader(self.filename, None)),
+                              [])
+            os.write(self.fd, self.lines[2:].tostring())
+            res = list(self.handler._reader(self.filename, None))
+            self.assertEquals(len(res), 1)
+            self.assertEquals(res[0][4], self.lines[2:].tostring())
+            self.assertEquals(self.handler._readers[self.filename][1],
+                              3 * server.HRPT.line_size)
+        finally:
+            self.handler._fp.close()
+
+    def test_ignore_other_files(self):
+        """Test that files not matching the pattern are ignored
+        """
+        event = MagicMock()
+        event.pathname = "/tmp/something_else.txt"
+        self.handler.process_IN_MODIFY(event)
+        self.assertTrue(self.handler._fp is None)
+        self.assertEquals(self.handler._holder.add_many.call_count, 0)
+
 
 # CADU
-# HRPT
-# FileWatcher
 # MirrorWatcher
-# Cleaner
 
 class TestRequestManager(unittest.TestCase):
 
@@ -158,6 +374,32 @@ class TestRequestManager(unittest.TestCase):
         self.reqman.stop()
         self.assertFalse(self.reqman._loop)
 
+    def test_send(self):
+        """Test sending a reply
+        """
+        for binary in (False, True):
+            message = MagicMock()
+            message.binary = binary
+            message.__str__.return_value = "pytroll://bla scanline data"
+            self.reqman.send(message)
+            self.reqman._socket.send.assert_called_with(
+                "pytroll://bla scanline data")
+            self.assertEquals(message.__str__.call_count, 1)
+
+    @patch.object(server, "logger")
+    def test_send_binary_log(self, logger):
+        """Test that only the header of binary replies is logged
+        """
+        message = MagicMock()
+        message.binary = True
+        message.__str__.return_value = ("pytroll://bla scanline me@here "
+                                         "2015-01-01T00:00:00 v1.01 "
+                                         "binary/octet-stream 1 2 3 4")
+        self.reqman.send(message)
+        logger.debug.assert_called_once_with(
+            "Response: pytroll://bla scanline me@here "
+            "2015-01-01T00:00:00 v1.01 binary/octet-stream")
+
     def test_pong(self):
         """Test response to ping
         """
@@ -391,6 +633,10 @@ def suite():
     mysuite.addTest(loader.loadTestsFromTestCase(TestHeart))
     mysuite.addTest(loader.loadTestsFromTestCase(TestPublisher))
     mysuite.addTest(loader.loadTestsFromTestCase(TestHolder))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestHRPT))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestCleaner))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestFileWatcher))
+    mysuite.addTest(loader.loadTestsFromTestCase(TestEventHandler))
     mysuite.addTest(loader.loadTestsFromTestCase(TestRequestManager))
     mysuite.addTest(loader.loadTestsFromTestCase(TestServe))
 